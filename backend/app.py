@@ -1,53 +1,229 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, abort, request, jsonify, send_from_directory
+from flask.json.provider import DefaultJSONProvider
+from flask_compress import Compress
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit
+from werkzeug.security import safe_join
 import os
-import json
-from datetime import datetime
-import uuid
+import re
+import functools
+import hashlib
+import atexit
+import logging
+import logging.handlers
+import queue
+import mimetypes
+import time
+import threading
+import orjson
+import secrets
+from cachetools import TTLCache
 
 # Import AI utilities
-from utils.ai_engine import AIEngine
+from utils.ai_engine import get_engine
 from utils.conversation_manager import ConversationManager
 from utils.user_manager import UserManager
+from utils.chunk_batcher import ChunkBatcher
+
+# Log records are queued by the request threads and written by one listener
+# thread, so stdout I/O stays off the request path; LOG_LEVEL=WARNING silences the info lines
+_log_queue = queue.Queue(-1)
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(), handlers=[logging.handlers.QueueHandler(_log_queue)])
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_output)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+log = logging.getLogger(__name__)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson for request parsing and jsonify"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(
+            obj,
+            default=self.default,
+            option=orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS
+        ).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+class OrjsonPacketJSON:
+    """orjson adapter for Socket.IO packet encoding (stdlib-compatible dumps/loads)"""
+    
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return orjson.dumps(obj).decode()
+    
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__, static_folder='../frontend')
+app.json = OrjsonProvider(app)
+Compress(app)
 app.secret_key = os.getenv('SECRET_KEY', 'fast-learning-secret-key-change-in-production')
 CORS(app, supports_credentials=True)
-socketio = SocketIO(app, cors_allowed_origins="*")
+
+# async_mode defaults to eventlet/gevent when installed so emits don't block the generator.
+# SOCKETIO_SERIALIZER=msgpack switches to binary frames; clients must then
+# load the socket.io msgpack parser.
+socketio = SocketIO(
+    app,
+    cors_allowed_origins="*",
+    async_mode=os.getenv('SOCKETIO_ASYNC_MODE'),
+    json=OrjsonPacketJSON,
+    serializer=os.getenv('SOCKETIO_SERIALIZER', 'default')
+)
 
 # Initialize AI Engine, Conversation Manager, and User Manager
-ai_engine = AIEngine()
+ai_engine = get_engine()
 conversation_manager = ConversationManager()
 user_manager = UserManager()
 
-# Store active connections
-active_sessions = {}
+# Store active connections (bounded; entries expire after a day)
+active_sessions = TTLCache(maxsize=100_000, ttl=86400)
+active_sessions_lock = threading.Lock()
+
+def _now_iso(_cache=[0, '']):
+    """Current UTC time as ISO-8601, formatted at most once per second"""
+    ts = int(time.time())
+    if ts != _cache[0]:
+        _cache[0] = ts
+        _cache[1] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(ts))
+    return _cache[1]
+
+# Back-pressure: cap the number of generations running at once
+generation_slots = threading.BoundedSemaphore(int(os.getenv('MAX_CONCURRENT_GENERATIONS', 64)))
+
+# Number of recent messages passed verbatim; older turns are summarized
+CONTEXT_WINDOW = 6
+
+# Sessions with a summarize task running, so tasks never overlap per session
+_summarizing = set()
+_summarizing_lock = threading.Lock()
+
+def schedule_summary(session_id):
+    """Start a summarize task for the session unless one is already running"""
+    with _summarizing_lock:
+        if session_id in _summarizing:
+            return
+        _summarizing.add(session_id)
+    socketio.start_background_task(summarize_conversation, session_id)
+
+def summarize_conversation(session_id):
+    """
+    Background task: fold turns older than the context window into the summary
+    Waits until a full window's worth has accumulated, so most turns cost no
+    extra model call; until then those turns stay in the verbatim context
+    """
+    try:
+        pending = conversation_manager.get_unsummarized(session_id, k=CONTEXT_WINDOW)
+        if len(pending['messages']) < CONTEXT_WINDOW:
+            return
+        
+        summary = ai_engine.summarize_history(pending['summary'], pending['messages'])
+        conversation_manager.update_summary(session_id, summary, pending['upto'])
+    except Exception as e:
+        log.warning("Error summarizing conversation %s: %s", session_id, e)
+    finally:
+        with _summarizing_lock:
+            _summarizing.discard(session_id)
+
+# The model list never changes at runtime, so serialize it once
+_MODELS_JSON = orjson.dumps({
+    'models': [
+        {'id': 'gpt-3.5-turbo', 'name': 'GPT-3.5 Turbo', 'provider': 'OpenAI'},
+        {'id': 'gpt-4', 'name': 'GPT-4', 'provider': 'OpenAI'},
+        {'id': 'local-llama', 'name': 'Local LLaMA', 'provider': 'Hugging Face'},
+        {'id': 'local-mistral', 'name': 'Local Mistral', 'provider': 'Hugging Face'}
+    ]
+})
+
+# Local stylesheet/script references in the HTML pages, e.g. href="css/style.css"
+_ASSET_REF_RE = re.compile(r'((?:href|src)=")((?:css|js)/[^"?]+)"')
+
+@functools.lru_cache(maxsize=None)
+def _page_bytes(filepath):
+    """Read an HTML page once, tagging local assets with a content hash (?v=) for cache busting"""
+    def fingerprint(match):
+        asset_path = safe_join(app.static_folder, match.group(2))
+        try:
+            with open(asset_path, 'rb') as f:
+                digest = hashlib.blake2b(f.read(), digest_size=6).hexdigest()
+        except (OSError, TypeError):
+            return match.group(0)
+        return f'{match.group(1)}{match.group(2)}?v={digest}"'
+    
+    with open(filepath, encoding='utf-8') as f:
+        return _ASSET_REF_RE.sub(fingerprint, f.read()).encode()
+
+def _send_page(path):
+    """Serve an HTML page; always revalidated (304 via ETag) so deploys take effect at once"""
+    filepath = safe_join(app.static_folder, path)
+    if filepath is None or not os.path.isfile(filepath):
+        abort(404)
+    response = Response(_page_bytes(filepath), mimetype='text/html')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
+
+def _send_static(path):
+    """
+    Serve a frontend file: HTML pages from memory, other assets from disk
+    Fingerprinted (?v=) asset URLs are cached for a year, anything else is revalidated
+    """
+    if path.endswith('.html'):
+        return _send_page(path)
+    
+    response = _send_asset(path)
+    if request.args.get('v'):
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def _send_asset(path):
+    """Send a frontend file, using its precompressed .gz sibling when the client accepts gzip"""
+    gz_path = os.path.join(app.static_folder, path + '.gz')
+    if 'gzip' in request.accept_encodings and os.path.isfile(gz_path):
+        response = send_from_directory(
+            app.static_folder, path + '.gz',
+            mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        )
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+    return send_from_directory(app.static_folder, path)
 
 @app.route('/')
 def index():
-    return send_from_directory(app.static_folder, 'login.html')
+    return _send_static('login.html')
 
 @app.route('/login')
 @app.route('/login.html')
 def login_page():
-    return send_from_directory(app.static_folder, 'login.html')
+    return _send_static('login.html')
 
 @app.route('/app')
 @app.route('/index.html')
 def main_app():
-    return send_from_directory(app.static_folder, 'index.html')
+    return _send_static('index.html')
 
 @app.route('/<path:path>')
 def static_files(path):
-    return send_from_directory(app.static_folder, path)
+    return _send_static(path)
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     return jsonify({
         'status': 'healthy',
-        'timestamp': datetime.now().isoformat(),
+        'timestamp': _now_iso(),
         'ai_engine': 'ready'
     })
 
@@ -182,7 +358,7 @@ def chat():
     try:
         data = request.json
         user_message = data.get('message', '')
-        session_id = data.get('session_id', str(uuid.uuid4()))
+        session_id = data.get('session_id', secrets.token_hex(16))
         model = data.get('model', 'gpt-3.5-turbo')
         
         if not user_message:
@@ -191,34 +367,39 @@ def chat():
         # Get or create conversation
         conversation = conversation_manager.get_conversation(session_id)
         
-        # Add user message to conversation
+        # Add user message to conversation (persisted with the reply below)
         conversation_manager.add_message(session_id, {
             'role': 'user',
             'content': user_message,
-            'timestamp': datetime.now().isoformat()
-        })
+            'timestamp': _now_iso()
+        }, conversation=conversation, save=False)
         
         # Generate AI response
+        context = conversation_manager.get_compact_context(session_id, k=CONTEXT_WINDOW, conversation=conversation)
         ai_response = ai_engine.generate_response(
             message=user_message,
-            conversation_history=conversation['messages'],
-            model=model
+            conversation_history=context['recent'],
+            model=model,
+            summary=context['summary'],
+            session_id=session_id
         )
         
         # Add AI response to conversation
         conversation_manager.add_message(session_id, {
             'role': 'assistant',
-            'content': ai_response['content'],
-            'timestamp': datetime.now().isoformat(),
+            'content': ai_response.content,
+            'timestamp': _now_iso(),
             'model': model
-        })
+        }, conversation=conversation)
+        schedule_summary(session_id)
         
         return jsonify({
             'session_id': session_id,
-            'response': ai_response['content'],
+            'response': ai_response.content,
             'model': model,
-            'timestamp': datetime.now().isoformat(),
-            'tokens_used': ai_response.get('tokens_used', 0)
+            'timestamp': _now_iso(),
+            'tokens_used': ai_response.tokens_used,
+            'cached': ai_response.cached
         })
     
     except Exception as e:
@@ -269,109 +450,134 @@ def clear_conversations():
 @app.route('/api/models', methods=['GET'])
 def get_models():
     """Get available AI models"""
-    return jsonify({
-        'models': [
-            {'id': 'gpt-3.5-turbo', 'name': 'GPT-3.5 Turbo', 'provider': 'OpenAI'},
-            {'id': 'gpt-4', 'name': 'GPT-4', 'provider': 'OpenAI'},
-            {'id': 'local-llama', 'name': 'Local LLaMA', 'provider': 'Hugging Face'},
-            {'id': 'local-mistral', 'name': 'Local Mistral', 'provider': 'Hugging Face'}
-        ]
-    })
+    return Response(
+        _MODELS_JSON,
+        mimetype='application/json',
+        headers={'Cache-Control': 'public, max-age=3600'}
+    )
 
 # WebSocket Events for Real-time Chat
 @socketio.on('connect')
 def handle_connect():
     """Handle client connection"""
     session_id = request.sid
-    active_sessions[session_id] = {
-        'connected_at': datetime.now().isoformat()
-    }
+    with active_sessions_lock:
+        active_sessions[session_id] = {
+            'connected_at': _now_iso()
+        }
     emit('connected', {'session_id': session_id})
-    print(f"Client connected: {session_id}")
+    log.info("Client connected: %s", session_id)
 
 @socketio.on('disconnect')
 def handle_disconnect():
     """Handle client disconnection"""
     session_id = request.sid
-    if session_id in active_sessions:
-        del active_sessions[session_id]
-    print(f"Client disconnected: {session_id}")
+    with active_sessions_lock:
+        active_sessions.pop(session_id, None)
+    log.info("Client disconnected: %s", session_id)
 
 @socketio.on('send_message')
 def handle_message(data):
     """Handle incoming message via WebSocket"""
     try:
-        print(f"📨 Received message: {data}")
+        log.debug("📨 Received message: %s", data)
         user_message = data.get('message', '')
-        session_id = data.get('session_id', str(uuid.uuid4()))
+        session_id = data.get('session_id', secrets.token_hex(16))
         model = data.get('model', 'gpt-3.5-turbo')
         
-        print(f"💬 User: {user_message}")
-        print(f"🔑 Session: {session_id}")
+        log.debug("💬 User: %s", user_message)
+        log.debug("🔑 Session: %s", session_id)
         
         # Get conversation
         conversation = conversation_manager.get_conversation(session_id)
         
-        # Add user message
+        # Add user message (persisted with the reply once generation finishes)
         conversation_manager.add_message(session_id, {
             'role': 'user',
             'content': user_message,
-            'timestamp': datetime.now().isoformat()
-        })
+            'timestamp': _now_iso()
+        }, conversation=conversation, save=False)
         
         # Emit typing indicator
         emit('typing', {'is_typing': True})
-        print("⌨️  Typing indicator sent")
-        
-        # Generate AI response with streaming
-        print(f"🤖 Generating response with model: {model}")
-        ai_response = ai_engine.generate_response(
-            message=user_message,
-            conversation_history=conversation['messages'],
-            model=model,
-            stream=True
+        log.debug("⌨️  Typing indicator sent")
+        
+        # Generate off the handler so the server keeps servicing other sockets
+        socketio.start_background_task(
+            _run_generation,
+            request.sid,
+            session_id,
+            conversation,
+            user_message,
+            model,
+            int(data.get('batch_size', 2048)),
+            float(data.get('flush_interval_ms', 25))
         )
         
-        print(f"✅ AI Response generated: {ai_response.get('model', 'unknown')}")
-        
-        # Stream response back to client
-        full_response = ""
-        for chunk in ai_response['chunks']:
-            full_response += chunk
-            emit('message_chunk', {
-                'chunk': chunk,
-                'session_id': session_id
-            })
-        
-        print(f"📤 Streamed {len(full_response)} characters")
+    except Exception as e:
+        log.exception("❌ Error in handle_message")
+        emit('error', {'error': str(e)})
+
+def _run_generation(sid, session_id, conversation, user_message, model, batch_size, flush_interval_ms):
+    """Background task: generate a reply and stream it to the client's socket"""
+    try:
+        with generation_slots:
+            # Generate AI response with streaming
+            log.debug("🤖 Generating response with model: %s", model)
+            context = conversation_manager.get_compact_context(session_id, k=CONTEXT_WINDOW, conversation=conversation)
+            ai_response = ai_engine.generate_response(
+                message=user_message,
+                conversation_history=context['recent'],
+                model=model,
+                stream=True,
+                summary=context['summary'],
+                session_id=session_id
+            )
+            
+            log.debug("✅ AI Response generated: %s", ai_response.model)
+            
+            # Stream response back to client
+            batcher = ChunkBatcher(
+                # session_id is omitted: the socket already identifies the client
+                lambda text: socketio.emit('message_chunk', {'chunk': text}, to=sid),
+                batch_size=batch_size,
+                flush_interval_ms=flush_interval_ms
+            )
+            parts = []
+            for chunk in ai_response.chunks:
+                parts.append(chunk)
+                batcher.add(chunk)
+            batcher.flush()
+            full_response = ''.join(parts)
+        
+        log.debug("📤 Streamed %d characters", len(full_response))
         
         # Add AI response to conversation
         conversation_manager.add_message(session_id, {
             'role': 'assistant',
             'content': full_response,
-            'timestamp': datetime.now().isoformat(),
+            'timestamp': _now_iso(),
             'model': model
-        })
+        }, conversation=conversation)
+        schedule_summary(session_id)
         
         # Emit completion
-        emit('typing', {'is_typing': False})
-        emit('message_complete', {
+        socketio.emit('typing', {'is_typing': False}, to=sid)
+        socketio.emit('message_complete', {
             'session_id': session_id,
-            'timestamp': datetime.now().isoformat()
-        })
+            'timestamp': _now_iso()
+        }, to=sid)
         
-        print("✅ Message handling complete")
+        log.debug("✅ Message handling complete")
         
     except Exception as e:
-        print(f"❌ Error in handle_message: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        emit('error', {'error': str(e)})
+        log.exception("❌ Error in _run_generation")
+        socketio.emit('error', {'error': str(e)}, to=sid)
 
 @socketio.on('new_conversation')
 def handle_new_conversation():
     """Create a new conversation"""
-    session_id = str(uuid.uuid4())
+    session_id = secrets.token_hex(16)
     conversation = conversation_manager.get_conversation(session_id)
     emit('conversation_created', {
         'session_id': session_id,
@@ -383,5 +589,11 @@ if __name__ == '__main__':
     os.makedirs('backend/conversations', exist_ok=True)
     os.makedirs('data', exist_ok=True)
     
-    # Run the app
-    socketio.run(app, host='0.0.0.0', port=5000, debug=True)
+    # Run the app (debug/reloader only when explicitly requested; production
+    # deployments run under gunicorn with an eventlet worker, see render.yaml)
+    socketio.run(
+        app,
+        host=os.getenv('HOST', '0.0.0.0'),
+        port=int(os.getenv('PORT', 5000)),
+        debug=os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
+    )
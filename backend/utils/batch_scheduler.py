@@ -0,0 +1,147 @@
+import functools
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict
+
+log = logging.getLogger(__name__)
+
+def native_executor():
+    """
+    eventlet's tpool.execute when eventlet has green-patched threading, else None
+    Under the eventlet worker threading.Thread is a greenlet, so CPU-bound model
+    work must be handed to a native thread or it stalls every other request
+    """
+    try:
+        from eventlet import patcher, tpool
+    except ImportError:
+        return None
+    return tpool.execute if patcher.is_monkey_patched('thread') else None
+
+
+def run_native(fn: Callable, *args):
+    """Call fn(*args) on a native thread under eventlet, directly otherwise"""
+    execute = native_executor()
+    return fn(*args) if execute is None else execute(fn, *args)
+
+
+class BatchScheduler:
+    """
+    Micro-batches local model generation across concurrent requests
+    Prompts arriving within max_wait_ms (up to max_batch of them) are
+    left-padded into one batch and run through a single generate() call
+    All model work runs on the one worker thread, off the request threads
+    (handed to a native thread via tpool when running under eventlet)
+    Each batch is split into power-of-two length buckets before padding
+    """
+
+    def __init__(self, model, pad_token_id: int, device: str = 'cpu',
+                 max_batch: int = 8, max_wait_ms: float = 10, generate_kwargs: Dict = None):
+        self.model = model
+        self.pad_token_id = pad_token_id
+        self.device = device
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.generate_kwargs = generate_kwargs or {}
+
+        self._execute = native_executor()
+        if self._execute is not None:
+            log.info("✓ eventlet detected: local inference runs on native threads via tpool")
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, input_ids) -> Future:
+        """Queue a 1-D tensor of prompt ids; the future resolves to the new token ids"""
+        future = Future()
+        self._queue.put((input_ids, future))
+        return future
+
+    def run(self, fn: Callable, *args) -> Future:
+        """Run fn(*args) on the worker thread, serialized with the batched generate() calls"""
+        future = Future()
+        self._queue.put((functools.partial(fn, *args), future))
+        return future
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if callable(item[0]):
+                self._call(item)
+                continue
+
+            batch = [item]
+            calls = []
+            deadline = time.monotonic() + self.max_wait
+
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                # Calls that arrive mid-window run right after the batch
+                (calls if callable(item[0]) else batch).append(item)
+
+            for bucket in self._buckets(batch):
+                try:
+                    self._generate(bucket)
+                except Exception as e:
+                    for _, future in bucket:
+                        if not future.done():
+                            future.set_exception(e)
+
+            for call in calls:
+                self._call(call)
+
+    @staticmethod
+    def _buckets(batch):
+        """Group prompts by power-of-two length (min 32) so short ones aren't padded to long ones"""
+        buckets = {}
+        for item in batch:
+            bucket = max(32, 1 << (item[0].shape[-1] - 1).bit_length())
+            buckets.setdefault(bucket, []).append(item)
+        return buckets.values()
+
+    def _offload(self, fn: Callable, *args):
+        """Run fn off the eventlet hub when needed, so the worker yields while it computes"""
+        if self._execute is None:
+            return fn(*args)
+        return self._execute(fn, *args)
+
+    def _call(self, item):
+        fn, future = item
+        try:
+            future.set_result(self._offload(fn))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _generate(self, batch):
+        import torch
+
+        # Left-pad so every prompt ends where generation starts
+        max_len = max(ids.shape[-1] for ids, _ in batch)
+        input_ids = torch.full((len(batch), max_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), max_len), dtype=torch.long)
+        for i, (ids, _) in enumerate(batch):
+            input_ids[i, max_len - ids.shape[-1]:] = ids
+            attention_mask[i, max_len - ids.shape[-1]:] = 1
+
+        def generate():
+            with torch.inference_mode():
+                return self.model.generate(
+                    input_ids=input_ids.to(self.device),
+                    attention_mask=attention_mask.to(self.device),
+                    pad_token_id=self.pad_token_id,
+                    num_beams=1,
+                    **self.generate_kwargs
+                )
+
+        outputs = self._offload(generate)
+
+        for i, (_, future) in enumerate(batch):
+            future.set_result(outputs[i, max_len:])
@@ -0,0 +1,35 @@
+import time
+from typing import Callable, List
+
+
+class ChunkBatcher:
+    """
+    Coalesces small streamed chunks into larger frames
+    Flushes when the buffer reaches batch_size characters or
+    flush_interval_ms has elapsed since the last flush
+    """
+
+    def __init__(self, emit_fn: Callable[[str], None], batch_size: int = 2048, flush_interval_ms: float = 25):
+        self.emit_fn = emit_fn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000.0
+
+        self.buf: List[str] = []
+        self.nbytes = 0
+        self.last_flush = time.monotonic()
+
+    def add(self, chunk: str):
+        """Buffer a chunk, flushing if the size or time window is exceeded"""
+        self.buf.append(chunk)
+        self.nbytes += len(chunk)
+
+        if self.nbytes >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Emit everything buffered so far as a single frame"""
+        if self.buf:
+            self.emit_fn(''.join(self.buf))
+            self.buf = []
+            self.nbytes = 0
+        self.last_flush = time.monotonic()
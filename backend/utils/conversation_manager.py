@@ -1,21 +1,92 @@
 import os
-import json
-from datetime import datetime
+import atexit
+import logging
+import threading
+import time
+import orjson
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from itertools import islice
+from operator import attrgetter
 from typing import Dict, List
 import uuid
 
+log = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class ConvMeta:
+    """Listing entry for a conversation (orjson serializes it as an object)"""
+    session_id: str
+    title: str
+    created_at: str
+    updated_at: str
+    message_count: int
+
 class ConversationManager:
     """
     Manages conversation storage and retrieval
-    Stores conversations in JSON files
+    Stores each conversation as a small {id}.meta.json (title, timestamps,
+    summary, message_count) plus its messages in {id}.messages.jsonl
+    Changes are written back by a background flusher (at most flush_interval later)
     """
     
-    def __init__(self, storage_dir='backend/conversations'):
+    def __init__(self, storage_dir='backend/conversations', flush_interval: float = 0.5):
         self.storage_dir = storage_dir
         os.makedirs(storage_dir, exist_ok=True)
         
         # In-memory cache for active conversations
         self.active_conversations = {}
+        
+        # Bounded window of the latest messages per conversation, used as
+        # model context so the hot path never slices the full history
+        self.recent_messages = {}
+        self.recent_limit = 20
+        
+        # Messages already in each conversation's .messages.jsonl, so saves
+        # only append the ones added since
+        self._persisted_counts = {}
+        
+        # Listing metadata per file, reused while the file's mtime is unchanged
+        # (loaded lazily from a sidecar file that persists across restarts)
+        self._index_path = os.path.join(storage_dir, 'conversations.index')
+        self._index = None
+        
+        # Write-back: mutations mark a conversation dirty, the flusher saves it
+        self._dirty = set()
+        self._dirty_lock = threading.Lock()
+        # One flush at a time, so concurrent saves can't append the same messages twice
+        self._save_lock = threading.Lock()
+        self._flush_interval = flush_interval
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+        atexit.register(self.flush)
+    
+    def _mark_dirty(self, session_id: str):
+        with self._dirty_lock:
+            self._dirty.add(session_id)
+    
+    def _flush_loop(self):
+        while True:
+            time.sleep(self._flush_interval)
+            self.flush()
+    
+    def flush(self):
+        """Write every changed conversation to disk in one pass"""
+        with self._save_lock:
+            with self._dirty_lock:
+                dirty, self._dirty = self._dirty, set()
+            
+            for session_id in dirty:
+                conversation = self.active_conversations.get(session_id)
+                if conversation is None:
+                    continue
+                try:
+                    self._save_conversation(session_id, conversation)
+                except Exception:
+                    # Keep the flusher alive; retry on the next tick
+                    log.exception("Error saving conversation %s", session_id)
+                    self._mark_dirty(session_id)
     
     def get_conversation(self, session_id: str) -> Dict:
         """Get or create a conversation"""
@@ -24,34 +95,40 @@ class ConversationManager:
             return self.active_conversations[session_id]
         
         # Check file system
-        filepath = os.path.join(self.storage_dir, f"{session_id}.json")
-        
-        if os.path.exists(filepath):
-            with open(filepath, 'r') as f:
-                conversation = json.load(f)
-                self.active_conversations[session_id] = conversation
-                return conversation
+        conversation = self._load_conversation(session_id)
+        if conversation is not None:
+            self.active_conversations[session_id] = conversation
+            return conversation
         
         # Create new conversation
+        now = datetime.now().isoformat()
         conversation = {
             'session_id': session_id,
-            'created_at': datetime.now().isoformat(),
-            'updated_at': datetime.now().isoformat(),
+            'created_at': now,
+            'updated_at': now,
             'messages': [],
             'title': 'New Conversation',
             'metadata': {}
         }
         
         self.active_conversations[session_id] = conversation
-        self._save_conversation(session_id, conversation)
+        self._mark_dirty(session_id)
         
         return conversation
     
-    def add_message(self, session_id: str, message: Dict):
-        """Add a message to a conversation"""
-        conversation = self.get_conversation(session_id)
+    def add_message(self, session_id: str, message: Dict, conversation: Dict = None, save: bool = True):
+        """
+        Add a message to a conversation
+        Pass the already-fetched conversation to skip the lookup, and
+        save=False to leave it unmarked until a later add_message call
+        """
+        if conversation is None:
+            conversation = self.get_conversation(session_id)
         
+        # Seed the recent window before appending, so the message lands in it once
+        recent = self._get_recent(session_id, conversation)
         conversation['messages'].append(message)
+        recent.append(message)
         conversation['updated_at'] = datetime.now().isoformat()
         
         # Update title based on first user message
@@ -60,94 +137,267 @@ class ConversationManager:
             conversation['title'] = message['content'][:50] + ('...' if len(message['content']) > 50 else '')
         
         self.active_conversations[session_id] = conversation
-        self._save_conversation(session_id, conversation)
+        if save:
+            self._mark_dirty(session_id)
+    
+    def get_compact_context(self, session_id: str, k: int = 6, conversation: Dict = None) -> Dict:
+        """
+        Get the running summary plus the most recent k messages, widened to
+        include every message not yet folded into the summary
+        """
+        if conversation is None:
+            conversation = self.get_conversation(session_id)
+        
+        # Drop summaries that have gone stale
+        summary = conversation.get('summary', '')
+        summarized_at = conversation.get('summary_updated_at')
+        if summary and summarized_at and datetime.fromisoformat(summarized_at) < datetime.now() - timedelta(days=180):
+            summary = ''
+        
+        recent = self._get_recent(session_id, conversation)
+        keep = len(conversation['messages'])
+        if summary:
+            keep = max(k, keep - conversation.get('summarized_count', 0))
+        return {
+            'summary': summary,
+            'recent': list(islice(recent, max(len(recent) - keep, 0), None))
+        }
+    
+    def _get_recent(self, session_id: str, conversation: Dict) -> deque:
+        """Get the bounded recent-message window, seeding it from history"""
+        recent = self.recent_messages.get(session_id)
+        if recent is None:
+            recent = deque(conversation['messages'], maxlen=self.recent_limit)
+            self.recent_messages[session_id] = recent
+        return recent
+    
+    def get_unsummarized(self, session_id: str, k: int = 6) -> Dict:
+        """Get messages older than the k-window that are not yet in the summary"""
+        conversation = self.get_conversation(session_id)
+        summarized_count = conversation.get('summarized_count', 0)
+        upto = len(conversation['messages']) - k
+        
+        return {
+            'summary': conversation.get('summary', ''),
+            'messages': conversation['messages'][summarized_count:upto] if upto > summarized_count else [],
+            'upto': upto
+        }
+    
+    def update_summary(self, session_id: str, summary: str, summarized_count: int):
+        """Store a new running summary covering the first summarized_count messages"""
+        conversation = self.get_conversation(session_id)
+        
+        conversation['summary'] = summary
+        conversation['summarized_count'] = summarized_count
+        conversation['summary_updated_at'] = datetime.now().isoformat()
+        
+        self._mark_dirty(session_id)
     
     def get_all_conversations(self) -> List[Dict]:
         """Get all conversations (metadata only)"""
-        conversations = []
+        # List from disk, so write out pending changes first
+        self.flush()
+        index = self._load_index()
+        fresh = {}
+        changed = False
         
-        # Get all JSON files in storage directory
-        if os.path.exists(self.storage_dir):
-            for filename in os.listdir(self.storage_dir):
-                if filename.endswith('.json'):
-                    filepath = os.path.join(self.storage_dir, filename)
+        # Get all metadata files in storage directory (created in __init__);
+        # older single-file {id}.json conversations are listed too
+        with os.scandir(self.storage_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('.json') and entry.is_file(follow_symlinks=False):
+                    mtime_ns = entry.stat().st_mtime_ns
+                    cached = index.get(entry.name)
+                    if cached is not None and cached['mtime_ns'] == mtime_ns:
+                        fresh[entry.name] = cached
+                        continue
+                    
+                    # New or modified since last listed: parse it
                     try:
-                        with open(filepath, 'r') as f:
-                            conversation = json.load(f)
-                            # Return metadata only
-                            conversations.append({
-                                'session_id': conversation['session_id'],
-                                'title': conversation['title'],
-                                'created_at': conversation['created_at'],
-                                'updated_at': conversation['updated_at'],
-                                'message_count': len(conversation['messages'])
-                            })
+                        with open(entry.path, 'rb') as f:
+                            conversation = orjson.loads(f.read())
+                            # Keep metadata only
+                            fresh[entry.name] = {
+                                'mtime_ns': mtime_ns,
+                                'meta': ConvMeta(
+                                    conversation['session_id'],
+                                    conversation['title'],
+                                    conversation['created_at'],
+                                    conversation['updated_at'],
+                                    conversation['message_count'] if 'message_count' in conversation else len(conversation['messages'])
+                                )
+                            }
+                            changed = True
                     except Exception as e:
-                        print(f"Error loading conversation {filename}: {e}")
+                        log.warning("Error loading conversation %s: %s", entry.name, e)
+        
+        # Persist the index when files were added, changed or deleted
+        if changed or len(fresh) != len(index):
+            self._save_index(fresh)
+        self._index = fresh
+        conversations = [item['meta'] for item in fresh.values()]
         
         # Sort by updated_at (most recent first)
-        conversations.sort(key=lambda x: x['updated_at'], reverse=True)
+        conversations.sort(key=attrgetter('updated_at'), reverse=True)
         
         return conversations
     
+    def _load_index(self) -> Dict:
+        """Load the listing index on first use"""
+        if self._index is None:
+            try:
+                with open(self._index_path, 'rb') as f:
+                    self._index = {
+                        name: {'mtime_ns': item['mtime_ns'], 'meta': ConvMeta(**item['meta'])}
+                        for name, item in orjson.loads(f.read()).items()
+                    }
+            except (OSError, orjson.JSONDecodeError, KeyError, TypeError):
+                self._index = {}
+        return self._index
+    
+    def _save_index(self, index: Dict):
+        try:
+            self._write_atomic(self._index_path, orjson.dumps(index))
+        except OSError as e:
+            log.warning("Could not write conversation index: %s", e)
+    
     def delete_conversation(self, session_id: str):
         """Delete a conversation"""
-        # Remove from cache
-        if session_id in self.active_conversations:
-            del self.active_conversations[session_id]
-        
-        # Remove file
-        filepath = os.path.join(self.storage_dir, f"{session_id}.json")
-        if os.path.exists(filepath):
-            os.remove(filepath)
+        # Hold the save lock so an in-progress flush can't re-create the files
+        with self._save_lock:
+            # Remove from cache (the flusher skips conversations no longer cached)
+            with self._dirty_lock:
+                self._dirty.discard(session_id)
+            if session_id in self.active_conversations:
+                del self.active_conversations[session_id]
+            self.recent_messages.pop(session_id, None)
+            self._persisted_counts.pop(session_id, None)
+            
+            # Remove files
+            for filepath in (self._meta_path(session_id), self._messages_path(session_id), self._legacy_path(session_id)):
+                if os.path.exists(filepath):
+                    os.remove(filepath)
     
     def clear_all(self):
         """Clear all conversations"""
-        # Clear cache
-        self.active_conversations = {}
+        # Hold the save lock so an in-progress flush can't re-create any files
+        with self._save_lock:
+            # Clear cache
+            with self._dirty_lock:
+                self._dirty = set()
+            self.active_conversations = {}
+            self.recent_messages = {}
+            self._persisted_counts = {}
+            
+            # Remove all files
+            with os.scandir(self.storage_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith(('.json', '.jsonl')) and entry.is_file(follow_symlinks=False):
+                        os.remove(entry.path)
+    
+    def _meta_path(self, session_id: str) -> str:
+        return os.path.join(self.storage_dir, f"{session_id}.meta.json")
+    
+    def _messages_path(self, session_id: str) -> str:
+        return os.path.join(self.storage_dir, f"{session_id}.messages.jsonl")
+    
+    def _legacy_path(self, session_id: str) -> str:
+        return os.path.join(self.storage_dir, f"{session_id}.json")
+    
+    def _load_conversation(self, session_id: str):
+        """Read a conversation from disk, or None if it doesn't exist"""
+        meta_path = self._meta_path(session_id)
+        if os.path.exists(meta_path):
+            with open(meta_path, 'rb') as f:
+                conversation = orjson.loads(f.read())
+            conversation.pop('message_count', None)
+            
+            messages_path = self._messages_path(session_id)
+            if os.path.exists(messages_path):
+                with open(messages_path, 'rb') as f:
+                    conversation['messages'] = [orjson.loads(line) for line in f if line.strip()]
+            else:
+                conversation['messages'] = []
+            self._persisted_counts[session_id] = len(conversation['messages'])
+            return conversation
         
-        # Remove all files
-        if os.path.exists(self.storage_dir):
-            for filename in os.listdir(self.storage_dir):
-                if filename.endswith('.json'):
-                    filepath = os.path.join(self.storage_dir, filename)
-                    os.remove(filepath)
+        # Single-file format, migrated on its next save
+        legacy_path = self._legacy_path(session_id)
+        if os.path.exists(legacy_path):
+            with open(legacy_path, 'rb') as f:
+                return orjson.loads(f.read())
+        
+        return None
     
     def _save_conversation(self, session_id: str, conversation: Dict):
-        """Save conversation to file"""
-        filepath = os.path.join(self.storage_dir, f"{session_id}.json")
+        """Save conversation to files: metadata, plus the messages added since the last save"""
+        # Snapshot the dict and the length once; requests and summarize
+        # tasks may add keys or messages while this runs
+        meta = dict(conversation)
+        messages = meta.pop('messages')
+        count = len(messages)
+        meta['message_count'] = count
         
-        with open(filepath, 'w') as f:
-            json.dump(conversation, f, indent=2)
+        persisted = self._persisted_counts.get(session_id)
+        if persisted is not None and persisted <= count:
+            self._append_messages(session_id, messages[persisted:count])
+        else:
+            # Unknown on-disk state (new or legacy conversation): write it whole
+            self._write_atomic(self._messages_path(session_id), b''.join(orjson.dumps(msg) + b'\n' for msg in messages[:count]))
+        self._persisted_counts[session_id] = count
+        
+        self._write_atomic(self._meta_path(session_id), orjson.dumps(meta))
+        
+        legacy_path = self._legacy_path(session_id)
+        if os.path.exists(legacy_path):
+            os.remove(legacy_path)
+    
+    @staticmethod
+    def _write_atomic(filepath: str, data: bytes):
+        """Replace a file's contents via a temp file, so readers never see a partial write"""
+        tmp = filepath + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, filepath)
+    
+    def _append_messages(self, session_id: str, messages: List[Dict]):
+        """Append messages to the conversation's JSONL log, one line each"""
+        if messages:
+            with open(self._messages_path(session_id), 'ab') as f:
+                f.write(b''.join(orjson.dumps(msg) + b'\n' for msg in messages))
     
     def export_conversation(self, session_id: str, format='json') -> str:
         """Export conversation in different formats"""
         conversation = self.get_conversation(session_id)
         
         if format == 'json':
-            return json.dumps(conversation, indent=2)
+            return orjson.dumps(conversation, option=orjson.OPT_INDENT_2).decode()
         
         elif format == 'text':
-            text = f"Conversation: {conversation['title']}\n"
-            text += f"Created: {conversation['created_at']}\n"
-            text += "=" * 50 + "\n\n"
+            parts = [
+                f"Conversation: {conversation['title']}\n",
+                f"Created: {conversation['created_at']}\n",
+                "=" * 50 + "\n\n"
+            ]
             
             for msg in conversation['messages']:
                 role = "You" if msg['role'] == 'user' else "AI"
-                text += f"{role}: {msg['content']}\n\n"
+                parts.append(f"{role}: {msg['content']}\n\n")
             
-            return text
+            return ''.join(parts)
         
         elif format == 'markdown':
-            md = f"# {conversation['title']}\n\n"
-            md += f"**Created:** {conversation['created_at']}\n\n"
-            md += "---\n\n"
+            parts = [
+                f"# {conversation['title']}\n\n",
+                f"**Created:** {conversation['created_at']}\n\n",
+                "---\n\n"
+            ]
             
             for msg in conversation['messages']:
                 role = "**You**" if msg['role'] == 'user' else "**AI**"
-                md += f"{role}: {msg['content']}\n\n"
+                parts.append(f"{role}: {msg['content']}\n\n")
             
-            return md
+            return ''.join(parts)
         
         else:
-            return json.dumps(conversation, indent=2)
+            return orjson.dumps(conversation, option=orjson.OPT_INDENT_2).decode()
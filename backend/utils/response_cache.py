@@ -0,0 +1,131 @@
+import os
+import logging
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    Two-tier cache for generated responses
+    Exact tier: blake2b(model + message + context) -> response, LRU with TTL
+    Semantic tier (optional): embedding similarity over cached prompts that
+    share the same scope (model + context)
+    context is everything else the model sees (summary and recent messages)
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: int = 3600, similarity: float = 0.95):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.similarity = similarity
+
+        # key -> (expires_at, content, model), shared by request threads
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Semantic tier is opt-in since it loads an embedding model
+        self._encoder = None
+        self._vectors = None
+        # (scope, key) per row of _vectors; both are swapped together under the lock
+        self._vector_keys = []
+        self._vector_lock = threading.Lock()
+        if os.getenv('SEMANTIC_CACHE', '').lower() in ('1', 'true', 'yes'):
+            self._init_semantic_tier()
+
+    def _init_semantic_tier(self):
+        """Load a small sentence embedding model for similarity lookups"""
+        try:
+            import numpy as np
+            from sentence_transformers import SentenceTransformer
+
+            self._np = np
+            self._encoder = SentenceTransformer(os.getenv('SEMANTIC_CACHE_MODEL', 'all-MiniLM-L6-v2'))
+            self._vectors = np.empty((0, self._encoder.get_sentence_embedding_dimension()), dtype=np.float32)
+            log.info("✓ Semantic response cache enabled")
+        except (ImportError, Exception) as e:
+            log.warning("⚠ Semantic cache unavailable: %s", e)
+            self._encoder = None
+
+    @staticmethod
+    def make_key(model: str, message: str, context: str = '') -> bytes:
+        """Hash the inputs that determine a response"""
+        return hashlib.blake2b(
+            (model + '\x00' + message + '\x00' + context).encode(),
+            digest_size=16
+        ).digest()
+
+    @staticmethod
+    def make_scope(model: str, context: str = '') -> bytes:
+        """Hash the context a semantic match must share (everything but the message)"""
+        return hashlib.blake2b((model + '\x00' + context).encode(), digest_size=16).digest()
+
+    def get(self, key: bytes, message: str = None, scope: bytes = None) -> Optional[Tuple[str, str]]:
+        """Return (content, model) for a cached response, or None"""
+        hit = self._get_exact(key)
+        if hit is None and message is not None and scope is not None and self._encoder is not None:
+            hit = self._get_semantic(message, scope)
+        return hit
+
+    def put(self, key: bytes, content: str, model: str, message: str = None, scope: bytes = None):
+        """Store a generated response"""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, content, model)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+        if message is not None and scope is not None and self._encoder is not None:
+            self._add_vector(message, key, scope)
+
+    def _get_exact(self, key: bytes) -> Optional[Tuple[str, str]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, content, model = entry
+            if time.monotonic() > expires_at:
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return content, model
+
+    def _embed(self, message: str):
+        return self._encoder.encode([message], normalize_embeddings=True).astype(self._np.float32)
+
+    def _get_semantic(self, message: str, scope: bytes) -> Optional[Tuple[str, str]]:
+        if not self._vector_keys:
+            return None
+
+        query = self._embed(message)[0]
+        with self._vector_lock:
+            vectors, vector_keys = self._vectors, self._vector_keys
+
+        # Only prompts cached for the same model and conversation state qualify
+        scores = vectors @ query
+        in_scope = self._np.fromiter((s == scope for s, _ in vector_keys), dtype=bool, count=len(vector_keys))
+        scores[~in_scope] = -1.0
+        best = int(scores.argmax())
+        if scores[best] < self.similarity:
+            return None
+
+        return self._get_exact(vector_keys[best][1])
+
+    def _add_vector(self, message: str, key: bytes, scope: bytes):
+        vector = self._embed(message)
+        with self._vector_lock:
+            vectors = self._np.vstack([self._vectors, vector])
+            vector_keys = self._vector_keys + [(scope, key)]
+
+            # Keep the semantic index no larger than the exact tier
+            overflow = len(vector_keys) - self.maxsize
+            if overflow > 0:
+                vectors = vectors[overflow:]
+                vector_keys = vector_keys[overflow:]
+
+            self._vectors, self._vector_keys = vectors, vector_keys
@@ -1,16 +1,25 @@
 import os
-import json
+import orjson
+import atexit
 import hashlib
+import hmac
+import logging
+import threading
+import time
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import Dict, Optional
 
+log = logging.getLogger(__name__)
+
 class UserManager:
     """
     Manages user registration, authentication, and session handling
+    Users and sessions are held in memory; changes are written back to
+    their JSON files by a background flusher (at most flush_interval later)
     """
     
-    def __init__(self, users_dir='backend/users'):
+    def __init__(self, users_dir='backend/users', flush_interval: float = 1.0, sweep_interval: float = 300.0):
         self.users_dir = users_dir
         self.users_file = os.path.join(users_dir, 'users.json')
         self.sessions_file = os.path.join(users_dir, 'sessions.json')
@@ -21,36 +30,122 @@ class UserManager:
             self._save_json(self.users_file, {})
         if not os.path.exists(self.sessions_file):
             self._save_json(self.sessions_file, {})
+        
+        self._users = self._load_json(self.users_file)
+        
+        # Session token -> (user_id, expires_at epoch seconds); persisted only as
+        # a snapshot for restarts, so verify_session never touches disk
+        self._sessions = {}
+        legacy_sessions = False
+        for token, session in self._load_json(self.sessions_file).items():
+            if isinstance(session, dict):
+                # Older {'user_id', 'created_at', 'expires_at'} records
+                expires_at = session['expires_at']
+                if isinstance(expires_at, str):
+                    expires_at = int(datetime.fromisoformat(expires_at).timestamp())
+                session = (session['user_id'], expires_at)
+                legacy_sessions = True
+            self._sessions[token] = tuple(session)
+        
+        # Lowercased username/email -> user_id, so lookups don't scan every user
+        self._by_username = {}
+        self._by_email = {}
+        for user_data in self._users.values():
+            self._index_user(user_data)
+        
+        # Write-back: mutations mark a file dirty, the flusher persists it
+        self._dirty = set()
+        self._dirty_lock = threading.Lock()
+        # One flush at a time, so the flusher and atexit never share a .tmp file
+        self._save_lock = threading.Lock()
+        self._flush_interval = flush_interval
+        self._sweep_interval = sweep_interval
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+        atexit.register(self.flush)
+        if legacy_sessions:
+            self._mark_dirty(self.sessions_file)
+    
+    def _mark_dirty(self, filepath: str):
+        with self._dirty_lock:
+            self._dirty.add(filepath)
+    
+    def _flush_loop(self):
+        next_sweep = time.monotonic() + self._sweep_interval
+        while True:
+            time.sleep(self._flush_interval)
+            if time.monotonic() >= next_sweep:
+                self._sweep_expired_sessions()
+                next_sweep = time.monotonic() + self._sweep_interval
+            self.flush()
+    
+    def _sweep_expired_sessions(self):
+        """Drop every expired session in one pass"""
+        now = time.time()
+        expired = [token for token, session in list(self._sessions.items()) if now > session[1]]
+        for token in expired:
+            self._sessions.pop(token, None)
+        if expired:
+            self._mark_dirty(self.sessions_file)
+    
+    def flush(self):
+        """Write any changed users/sessions data to disk"""
+        with self._save_lock:
+            with self._dirty_lock:
+                dirty, self._dirty = self._dirty, set()
+            
+            # orjson serializes without releasing the GIL, so each snapshot is consistent
+            for filepath in dirty:
+                try:
+                    self._save_json(filepath, self._users if filepath == self.users_file else self._sessions)
+                except Exception:
+                    # Keep the flusher alive; retry on the next tick
+                    log.exception("Error saving %s", filepath)
+                    self._mark_dirty(filepath)
+    
+    def _index_user(self, user_data: Dict):
+        """Add a user to the username/email indexes"""
+        self._by_username[user_data['username'].lower()] = user_data['user_id']
+        self._by_email[user_data['email'].lower()] = user_data['user_id']
     
     def _save_json(self, filepath: str, data: dict):
         """Save data to JSON file"""
-        with open(filepath, 'w') as f:
-            json.dump(data, f, indent=2)
+        # Write a temp file and rename it over the old one, so a crash
+        # mid-write never leaves a truncated file
+        tmp = filepath + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(orjson.dumps(data))
+        os.replace(tmp, filepath)
     
     def _load_json(self, filepath: str) -> dict:
         """Load data from JSON file"""
-        with open(filepath, 'r') as f:
-            return json.load(f)
+        with open(filepath, 'rb') as f:
+            return orjson.loads(f.read())
     
-    def _hash_password(self, password: str, salt: str = None) -> tuple:
+    def _hash_password(self, password: str, salt: str = None, algo: str = 'scrypt') -> tuple:
         """Hash password with salt"""
         if salt is None:
             salt = uuid.uuid4().hex
         
-        # Use SHA-256 for password hashing
-        hashed = hashlib.sha256((password + salt).encode()).hexdigest()
+        if algo == 'scrypt':
+            # Memory-hard KDF (16 MiB per hash)
+            hashed = hashlib.scrypt(password.encode(), salt=salt.encode(), n=16384, r=8, p=1, dklen=32).hex()
+        else:
+            # Accounts created before scrypt: single SHA-256 over password + salt,
+            # fed incrementally instead of concatenating first
+            digest = hashlib.sha256(password.encode())
+            digest.update(salt.encode())
+            hashed = digest.hexdigest()
         return hashed, salt
     
     def register_user(self, username: str, email: str, password: str, full_name: str = '') -> Dict:
         """Register a new user"""
-        users = self._load_json(self.users_file)
+        users = self._users
         
         # Check if username or email already exists
-        for user_id, user_data in users.items():
-            if user_data['username'].lower() == username.lower():
-                return {'success': False, 'error': 'Username already exists'}
-            if user_data['email'].lower() == email.lower():
-                return {'success': False, 'error': 'Email already exists'}
+        if username.lower() in self._by_username:
+            return {'success': False, 'error': 'Username already exists'}
+        if email.lower() in self._by_email:
+            return {'success': False, 'error': 'Email already exists'}
         
         # Validate inputs
         if len(username) < 3:
@@ -71,12 +166,14 @@ class UserManager:
             'full_name': full_name,
             'password_hash': password_hash,
             'salt': salt,
+            'hash_algo': 'scrypt',
             'created_at': datetime.now().isoformat(),
             'last_login': None,
             'is_active': True
         }
         
-        self._save_json(self.users_file, users)
+        self._mark_dirty(self.users_file)
+        self._index_user(users[user_id])
         
         return {
             'success': True,
@@ -88,15 +185,9 @@ class UserManager:
     
     def authenticate_user(self, username_or_email: str, password: str) -> Dict:
         """Authenticate user with username/email and password"""
-        users = self._load_json(self.users_file)
-        
         # Find user by username or email
-        user_data = None
-        for uid, data in users.items():
-            if (data['username'].lower() == username_or_email.lower() or 
-                data['email'].lower() == username_or_email.lower()):
-                user_data = data
-                break
+        key = username_or_email.lower()
+        user_data = self._users.get(self._by_username.get(key) or self._by_email.get(key))
         
         if not user_data:
             return {'success': False, 'error': 'Invalid username/email or password'}
@@ -105,15 +196,19 @@ class UserManager:
             return {'success': False, 'error': 'Account is inactive'}
         
         # Verify password
-        password_hash, _ = self._hash_password(password, user_data['salt'])
+        password_hash, _ = self._hash_password(password, user_data['salt'], user_data.get('hash_algo', 'sha256'))
         
-        if password_hash != user_data['password_hash']:
+        if not hmac.compare_digest(password_hash, user_data['password_hash']):
             return {'success': False, 'error': 'Invalid username/email or password'}
         
-        # Update last login
+        # Upgrade legacy SHA-256 hashes now that we have the plaintext
+        if user_data.get('hash_algo') != 'scrypt':
+            user_data['password_hash'], user_data['salt'] = self._hash_password(password)
+            user_data['hash_algo'] = 'scrypt'
+        
+        # Update last login in memory; the flusher persists it
         user_data['last_login'] = datetime.now().isoformat()
-        users[user_data['user_id']] = user_data
-        self._save_json(self.users_file, users)
+        self._mark_dirty(self.users_file)
         
         # Create session
         session_token = self._create_session(user_data['user_id'])
@@ -129,18 +224,12 @@ class UserManager:
     
     def _create_session(self, user_id: str, expires_in_days: int = 7) -> str:
         """Create a new session for user"""
-        sessions = self._load_json(self.sessions_file)
+        sessions = self._sessions
         
         session_token = str(uuid.uuid4())
-        expires_at = (datetime.now() + timedelta(days=expires_in_days)).isoformat()
-        
-        sessions[session_token] = {
-            'user_id': user_id,
-            'created_at': datetime.now().isoformat(),
-            'expires_at': expires_at
-        }
+        sessions[session_token] = (user_id, int(time.time()) + expires_in_days * 86400)
         
-        self._save_json(self.sessions_file, sessions)
+        self._mark_dirty(self.sessions_file)
         return session_token
     
     def verify_session(self, session_token: str) -> Optional[Dict]:
@@ -148,30 +237,20 @@ class UserManager:
         if not session_token:
             return None
         
-        sessions = self._load_json(self.sessions_file)
-        
-        if session_token not in sessions:
+        session = self._sessions.get(session_token)
+        if session is None:
             return None
         
-        session = sessions[session_token]
-        
-        # Check if session expired
-        expires_at = datetime.fromisoformat(session['expires_at'])
-        if datetime.now() > expires_at:
-            # Remove expired session
-            del sessions[session_token]
-            self._save_json(self.sessions_file, sessions)
+        # Expired sessions are left for the periodic sweep to remove
+        user_id, expires_at = session
+        if time.time() > expires_at:
             return None
         
         # Get user data
-        users = self._load_json(self.users_file)
-        user_id = session['user_id']
-        
-        if user_id not in users:
+        user_data = self._users.get(user_id)
+        if user_data is None:
             return None
         
-        user_data = users[user_id]
-        
         return {
             'user_id': user_data['user_id'],
             'username': user_data['username'],
@@ -183,18 +262,18 @@ class UserManager:
     
     def logout(self, session_token: str) -> bool:
         """Logout user by removing session"""
-        sessions = self._load_json(self.sessions_file)
+        sessions = self._sessions
         
         if session_token in sessions:
             del sessions[session_token]
-            self._save_json(self.sessions_file, sessions)
+            self._mark_dirty(self.sessions_file)
             return True
         
         return False
     
     def get_user_by_id(self, user_id: str) -> Optional[Dict]:
         """Get user data by user ID"""
-        users = self._load_json(self.users_file)
+        users = self._users
         
         if user_id not in users:
             return None
@@ -212,7 +291,7 @@ class UserManager:
     
     def update_user_profile(self, user_id: str, full_name: str = None, email: str = None) -> Dict:
         """Update user profile information"""
-        users = self._load_json(self.users_file)
+        users = self._users
         
         if user_id not in users:
             return {'success': False, 'error': 'User not found'}
@@ -224,19 +303,20 @@ class UserManager:
         
         if email is not None:
             # Check if email already used by another user
-            for uid, data in users.items():
-                if uid != user_id and data['email'].lower() == email.lower():
-                    return {'success': False, 'error': 'Email already in use'}
+            if self._by_email.get(email.lower(), user_id) != user_id:
+                return {'success': False, 'error': 'Email already in use'}
+            self._by_email.pop(user_data['email'].lower(), None)
+            self._by_email[email.lower()] = user_id
             user_data['email'] = email
         
         users[user_id] = user_data
-        self._save_json(self.users_file, users)
+        self._mark_dirty(self.users_file)
         
         return {'success': True, 'message': 'Profile updated successfully'}
     
     def change_password(self, user_id: str, old_password: str, new_password: str) -> Dict:
         """Change user password"""
-        users = self._load_json(self.users_file)
+        users = self._users
         
         if user_id not in users:
             return {'success': False, 'error': 'User not found'}
@@ -244,8 +324,8 @@ class UserManager:
         user_data = users[user_id]
         
         # Verify old password
-        old_hash, _ = self._hash_password(old_password, user_data['salt'])
-        if old_hash != user_data['password_hash']:
+        old_hash, _ = self._hash_password(old_password, user_data['salt'], user_data.get('hash_algo', 'sha256'))
+        if not hmac.compare_digest(old_hash, user_data['password_hash']):
             return {'success': False, 'error': 'Current password is incorrect'}
         
         # Validate new password
@@ -256,8 +336,9 @@ class UserManager:
         new_hash, new_salt = self._hash_password(new_password)
         user_data['password_hash'] = new_hash
         user_data['salt'] = new_salt
+        user_data['hash_algo'] = 'scrypt'
         
         users[user_id] = user_data
-        self._save_json(self.users_file, users)
+        self._mark_dirty(self.users_file)
         
         return {'success': True, 'message': 'Password changed successfully'}